@@ -1,9 +1,12 @@
-import os, json, asyncio, unicodedata
+import os, re, time, heapq, asyncio, unicodedata
 from dataclasses import dataclass, asdict
-from typing import Optional, Dict, List
+from functools import lru_cache
+from collections import defaultdict
+from typing import Optional, Dict, List, Set, Tuple
 from datetime import datetime, timedelta, timezone
 
 import discord
+import orjson
 from discord import app_commands
 
 CONFIG = {
@@ -13,56 +16,71 @@ CONFIG = {
     "DEFAULT_BOAT": "",
     "FC_CHANNEL_MAP": {}
 }
-DATA_FILE = "submarine_tasks.json"
+DATA_FILE = "submarine_tasks.jsonl"
 JST = CONFIG["TZ"]
 
+def _nfkc(s: str) -> str:
+    # ASCII は NFKC で変化しないので正規化を省略
+    return s if s.isascii() else unicodedata.normalize("NFKC", s)
+
 FC_ALIASES = {
     "alexander": {"a","al","ale","alex","alexan","alexander"},
     "pandemonium": {"p","pa","pan","pand","pande","pandemo","pandemonium"},
 }
+# 別名 → 正式名（"a" → "Alexander" など）
+_FC_LOOKUP = {a: c.capitalize() for c, aliases in FC_ALIASES.items() for a in aliases | {c}}
+
+@lru_cache(maxsize=256)
 def normalize_fc(s: str) -> str:
     if not s: return ""
-    t = unicodedata.normalize("NFKC", s).strip().lower()
-    for canon, aliases in FC_ALIASES.items():
-        if t == canon or t in aliases:
-            return "Alexander" if canon == "alexander" else "Pandemonium"
+    t = _nfkc(s).strip().lower()
+    v = _FC_LOOKUP.get(t)
+    if v: return v
     if "alexander".startswith(t): return "Alexander"
     if "pandemonium".startswith(t): return "Pandemonium"
     return s
 
+@lru_cache(maxsize=256)
 def normalize_boat(s: str) -> str:
-    t = unicodedata.normalize("NFKC", s or "").strip()
+    t = _nfkc(s or "").strip()
     return t if t in {"1","2","3","4"} else t
 
+_DELTA_RE = re.compile(r"(\d+)[ :/+]*(h|min|m)")
+_DELTA_FULL_RE = re.compile(r"(?:[ :/+]*\d+[ :/+]*(?:h|min|m))*[ :/+]*(\d*)[ :/+]*")
+
+@lru_cache(maxsize=256)
 def parse_delta(s: str) -> timedelta:
-    s = unicodedata.normalize("NFKC", (s or "")).strip().lower()
+    s = _nfkc(s or "").strip().lower()
     s = s.replace("minutes","min").replace("minute","min").replace("分","min")
-    h=m=0; buf=""; i=0; last=None
-    while i < len(s):
-        ch = s[i]
-        if ch.isdigit(): buf+=ch; i+=1; continue
-        if ch=="h":
-            if not buf: raise ValueError("h の前に数字が必要です")
-            h += int(buf); buf=""; last="h"; i+=1; continue
-        if s.startswith("min", i):
-            if not buf: raise ValueError("min の前に数字が必要です")
-            m += int(buf); buf=""; last="m"; i+=3; continue
-        if ch=="m":
-            if not buf: raise ValueError("m の前に数字が必要です")
-            m += int(buf); buf=""; last="m"; i+=1; continue
-        if ch in (" ",":","/","+"): i+=1; continue
-        raise ValueError("時間指定が不正です（例: 18h10min / 90min / 30分）")
-    if buf and last!="m": m += int(buf)
+    full = _DELTA_FULL_RE.fullmatch(s)
+    if not full: raise ValueError("時間指定が不正です（例: 18h10min / 90min / 30分）")
+    h=m=0; last=None
+    for num, unit in _DELTA_RE.findall(s):
+        if unit=="h": h += int(num)
+        else: m += int(num)
+        last=unit
+    # 単位なしの末尾の数字は分として扱う（18h10 → 18h10min）
+    if full.group(1) and last in (None,"h"): m += int(full.group(1))
     return timedelta(hours=h, minutes=m)
 
 def boat_label(boat_raw: str) -> str:
     s = normalize_boat(boat_raw)
     return f"{s}号" if s else "-"
 
-def jstfmt(epoch_utc: float) -> str:
+_ARRIVE_RE = re.compile(r"\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}")
+
+def parse_arrive(s: str) -> datetime:
+    # "YYYY-MM-DD HH:MM"（JST）。ゼロ埋めされた形は fromisoformat、それ以外（2025-10-5 9:05 など）は strptime
+    s = _nfkc(s)
+    if _ARRIVE_RE.fullmatch(s): dt = datetime.fromisoformat(s)
+    else: dt = datetime.strptime(s, "%Y-%m-%d %H:%M")
+    return dt.replace(tzinfo=JST)
+
+@lru_cache(maxsize=1024)
+def jstfmt(epoch_utc: int) -> str:
     return datetime.fromtimestamp(epoch_utc, tz=timezone.utc).astimezone(JST).strftime("%Y-%m-%d %H:%M JST")
 
-@dataclass
+@dataclass(slots=True)
 class Task:
     id: str
     guild_id: int
@@ -71,25 +89,86 @@ class Task:
     fc: str
     boat: str
     note: str
-    arrive_utc: float
+    arrive_utc: int
     done_arrive: bool = False
+    def __post_init__(self):
+        self.arrive_utc = int(self.arrive_utc)  # 旧データは float で保存されている
 
 class TaskStore:
+    # 追記型ジャーナル（1行1操作の JSON）。肥大化したら compact で書き直す
+    __slots__ = ("path","tasks","heap","by_guild_idx","f","_save_task")
     def __init__(self, path: str):
-        self.path = path; self.tasks: Dict[str, Task] = {}; self.load()
+        self.path = path; self.tasks: Dict[str, Task] = {}
+        # 到着順の (arrive_utc, id)。取消・変更前の古い要素は取り出し時に読み飛ばす
+        self.heap: List[Tuple[int, str]] = []
+        self.by_guild_idx: Dict[int, Set[str]] = defaultdict(set)
+        self.load(); self._reheap()
+        for t in self.tasks.values(): self.by_guild_idx[t.guild_id].add(t.id)
+        self.f = open(self.path,"ab")
+        self._save_task: Optional[asyncio.Task] = None
     def load(self):
-        if os.path.exists(self.path):
-            with open(self.path,"r",encoding="utf-8") as f: raw=json.load(f)
+        legacy = os.path.splitext(self.path)[0]+".json"
+        if not os.path.exists(self.path) and os.path.exists(legacy):
+            # 旧形式（全件 JSON）からの移行
+            with open(legacy,"rb") as f: raw=orjson.loads(f.read())
             for tid, rec in raw.items(): self.tasks[tid]=Task(**rec)
-        else: self.save()
+            self._rewrite(); return
+        if not os.path.exists(self.path): return
+        with open(self.path,"r+b") as f:
+            data=f.read()
+            if data and not data.endswith(b"\n"):
+                # 書き込み途中で落ちた末尾の行を切り捨てる（次の追記が繋がらないように）
+                data=data[:data.rfind(b"\n")+1]; f.truncate(len(data))
+        for line in data.splitlines():
+            try: rec=orjson.loads(line)
+            except ValueError: continue
+            if rec["op"]=="add": self.tasks[rec["task"]["id"]]=Task(**rec["task"])
+            elif rec["op"]=="del": self.tasks.pop(rec["id"], None)
+    def _append(self, *recs: dict):
+        self.f.write(b"".join(orjson.dumps(r)+b"\n" for r in recs)); self.save_soon()
     def save(self):
-        with open(self.path,"w",encoding="utf-8") as f:
-            json.dump({tid: vars(t) for tid,t in self.tasks.items()}, f, ensure_ascii=False, indent=2)
-    def add(self, t: Task): self.tasks[t.id]=t; self.save()
-    def remove(self, tid: str):
-        if tid in self.tasks: del self.tasks[tid]; self.save()
+        try: self.f.flush()
+        except ValueError: pass  # compact で閉じた直後（close 時に書き出し済み）
+    async def save_async(self):
+        # flush はスレッドで行いイベントループを止めない
+        await asyncio.to_thread(self.save)
+    def save_soon(self):
+        # 連続した変更は 200ms 以内にまとめて1回で書き出す
+        if self._save_task and not self._save_task.done(): return
+        try: loop=asyncio.get_running_loop()
+        except RuntimeError: return self.save()
+        self._save_task=loop.create_task(self._delayed_save())
+    async def _delayed_save(self):
+        await asyncio.sleep(0.2)
+        self._save_task=None  # flush 中の追記は次の書き出しを予約させる
+        await self.save_async()
+    def _reheap(self):
+        self.heap=[(t.arrive_utc, t.id) for t in self.tasks.values() if not t.done_arrive]; heapq.heapify(self.heap)
+    def next_arrival(self) -> Optional[int]:
+        # 先頭の古い要素を捨ててから次の到着時刻を返す
+        while self.heap:
+            arrive, tid = self.heap[0]; t = self.tasks.get(tid)
+            if t and not t.done_arrive and t.arrive_utc == arrive: return arrive
+            heapq.heappop(self.heap)
+        return None
+    def _rewrite(self):
+        tmp=self.path+".tmp"
+        with open(tmp,"wb") as f:
+            f.write(b"".join(orjson.dumps({"op":"add","task":t})+b"\n" for t in self.tasks.values()))
+        os.replace(tmp, self.path)
+    def compact(self):
+        if os.path.getsize(self.path) <= 2*len(self.tasks)*256: return
+        self.f.close(); self._rewrite(); self.f=open(self.path,"ab")
+        self._reheap()
+    # add は上書き（defer / edit 後の保存にも使う）
+    def add(self, t: Task):
+        self.tasks[t.id]=t; self.by_guild_idx[t.guild_id].add(t.id); heapq.heappush(self.heap, (t.arrive_utc, t.id)); self._append({"op":"add","task":t})
+    def remove(self, *tids: str):
+        gone=[t for t in (self.tasks.pop(tid, None) for tid in tids) if t is not None]
+        for t in gone: self.by_guild_idx[t.guild_id].discard(t.id)
+        if gone: self._append(*({"op":"del","id":t.id} for t in gone))
     def by_guild(self, gid: int) -> list:
-        return [t for t in self.tasks.values() if t.guild_id==gid]
+        return [self.tasks[tid] for tid in self.by_guild_idx.get(gid, ())]
 
 intents = discord.Intents.default()
 client = discord.Client(intents=intents)
@@ -105,26 +184,41 @@ async def send_arrival_notice(channel: discord.TextChannel, t: Task):
 async def schedule_runner():
     await client.wait_until_ready()
     while not client.is_closed():
-        now = datetime.now(timezone.utc).timestamp()
-        changed=False
-        for t in list(client.store.tasks.values()):
-            if not t.done_arrive and now >= t.arrive_utc:
-                ch = client.get_channel(t.channel_id)
-                if isinstance(ch, discord.TextChannel):
+        now = int(time.time())
+        done_ids=[]; store=client.store
+        # next_arrival が取消・変更済みの要素を捨てるので、先頭は常に有効な予約
+        while (nxt := store.next_arrival()) is not None and nxt <= now:
+            _, tid = heapq.heappop(store.heap); t = store.tasks[tid]
+            ch = client.get_channel(t.channel_id)
+            if isinstance(ch, discord.TextChannel):
+                try:
                     await send_arrival_notice(ch, t)
-                t.done_arrive=True; changed=True
-            if t.done_arrive: client.store.remove(t.id)
-        if changed: client.store.save()
-        await asyncio.sleep(5)
+                except discord.HTTPException as e:
+                    # 権限切れ等で1件失敗してもスケジューラは止めない
+                    print(f"Notice error ({t.id}):", e)
+            t.done_arrive=True; done_ids.append(tid)
+        # 到着済みはまとめて1回で削除
+        if done_ids: store.remove(*done_ids); store.compact()
+        # 次の到着までスリープ（タスク変更時は wake で起こす）
+        delay=max(0, nxt-time.time()) if nxt is not None else 3600  # 送信後の時刻から測る
+        try:
+            await asyncio.wait_for(client.wake.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        client.wake.clear()
 
 group = app_commands.Group(name="sub", description="潜水艦リマインダー（到着のみ通知）")
 
+# fc / boat は選択式にして Discord 側から正式名を受け取る
+FC_CHOICES = [app_commands.Choice(name=c.capitalize(), value=c.capitalize()) for c in FC_ALIASES]
+BOAT_CHOICES = [app_commands.Choice(name=f"{n}号", value=n) for n in ("1","2","3","4")]
+
 @group.command(name="help", description="使い方の説明（日本語）")
 async def help_cmd(inter: discord.Interaction):
     text=(
         "⚓ **潜水艦リマインダー（到着のみ通知）**\\n"
-        "• `/sub add duration:18h10min fc:a boat:1 note:メモ`\\n"
-        "  - `fc`: a→Alexander, p→Pandemonium（前方一致OK）\\n"
+        "• `/sub add duration:18h10min fc:Alexander boat:1 note:メモ`\\n"
+        "  - `fc` / `boat`: 候補から選択\\n"
         "  - `duration`: 18h10min / 90min / 30分\\n"
         "• `/sub list` / `/sub cancel id:<ID>` / `/sub defer id:<ID> delta:30min>` / `/sub edit ...`"
     )
@@ -132,9 +226,11 @@ async def help_cmd(inter: discord.Interaction):
 
 @group.command(name="add", description="出航時に登録（duration または arrive のどちらか必須）")
 @app_commands.describe(duration="18h10min / 90min / 30分", arrive="YYYY-MM-DD HH:MM（JST）",
-                       fc="a/p（前方一致OK）", boat="艦番号 1～4", note="メモ")
+                       fc="FC", boat="艦番号 1～4", note="メモ")
+@app_commands.choices(fc=FC_CHOICES, boat=BOAT_CHOICES)
 async def add(inter: discord.Interaction, duration: Optional[str]=None, arrive: Optional[str]=None,
-              fc: Optional[str]=None, boat: Optional[str]=None, note: Optional[str]=None):
+              fc: Optional[app_commands.Choice[str]]=None, boat: Optional[app_commands.Choice[str]]=None,
+              note: Optional[str]=None):
     await inter.response.defer(ephemeral=True)
     ch=inter.channel
     if not isinstance(ch, discord.TextChannel):
@@ -143,36 +239,37 @@ async def add(inter: discord.Interaction, duration: Optional[str]=None, arrive:
         td=parse_delta(duration); arrive_dt=datetime.now(JST)+td
     elif arrive:
         try:
-            arrive_dt=datetime.strptime(unicodedata.normalize("NFKC", arrive), "%Y-%m-%d %H:%M").replace(tzinfo=JST)
+            arrive_dt=parse_arrive(arrive)
         except Exception:
             return await inter.followup.send("arrive は 'YYYY-MM-DD HH:MM'（JST）で指定してください。", ephemeral=True)
     else:
         return await inter.followup.send("duration または arrive のどちらかを指定してください。", ephemeral=True)
 
-    fc_name=normalize_fc((fc or CONFIG["DEFAULT_FC"]).strip())
-    boat_name=normalize_boat((boat or CONFIG["DEFAULT_BOAT"]).strip())
+    fc_name=fc.value if fc else normalize_fc(CONFIG["DEFAULT_FC"].strip())
+    boat_name=boat.value if boat else normalize_boat(CONFIG["DEFAULT_BOAT"].strip())
     channel_id=CONFIG["FC_CHANNEL_MAP"].get(fc_name, ch.id)
 
     tid=os.urandom(4).hex()
     t=Task(id=tid, guild_id=inter.guild.id, channel_id=channel_id, user_id=inter.user.id,
-           fc=fc_name, boat=boat_name, note=note or "", arrive_utc=arrive_dt.astimezone(timezone.utc).timestamp())
+           fc=fc_name, boat=boat_name, note=note or "", arrive_utc=int(arrive_dt.astimezone(timezone.utc).timestamp()))
+    client.store.add(t); client.wake.set()
+
     embed = discord.Embed(
-            title="✅ 登録しました",
-            description="到着時刻になったらこのチャンネルに通知します。",
-        )
+        title="✅ 登録しました",
+        description="到着時刻になったらこのチャンネルに通知します。",
+    )
     embed.add_field(name="FC", value=f"{t.fc}", inline=True)
     embed.add_field(name="艦番号", value=f"{t.boat}号", inline=True)
     embed.add_field(name="到着予定", value=jstfmt(t.arrive_utc), inline=False)
-if t.note:
+    if t.note:
         embed.add_field(name="メモ", value=t.note, inline=False)
-
-await inter.followup.send(embed=embed, ephemeral=True)
+    await inter.followup.send(embed=embed, ephemeral=True)
 
 @group.command(name="list", description="予約一覧を表示")
 async def list_cmd(inter: discord.Interaction):
     tasks = client.store.by_guild(inter.guild.id)
     if not tasks:
-　　　　return await inter.response.send_message("予約はありません。", ephemeral=True)
+        return await inter.response.send_message("予約はありません。", ephemeral=True)
 
     # 到着が近い順に並べる
     tasks = sorted(tasks, key=lambda t: t.arrive_utc)
@@ -180,22 +277,21 @@ async def list_cmd(inter: discord.Interaction):
     # まずは応答枠を確保（時間がかかってもエラーにしない）
     await inter.response.defer(ephemeral=True)
 
-    # 1メッセージ10個までの制限があるので分割送信
+    embeds = []
+    for t in tasks:
+        fields = [{"name": "到着予定", "value": jstfmt(t.arrive_utc), "inline": False}]
+        if t.note:
+            fields.append({"name": "メモ", "value": t.note, "inline": False})
+        embeds.append(discord.Embed.from_dict({"title": f"🛳️ {t.fc or '-'} {boat_label(t.boat)}", "fields": fields}))
+
+    # 10個以内なら応答1回で返す
     chunk = 10
-    for i in range(0, len(tasks), chunk):
-        embeds = []
-        for t in tasks[i:i+chunk]:
-            e = discord.Embed(
-                title=f"🛳️ {t.fc or '-'} {boat_label(t.boat)}",
-                description="",
-            )
-            e.add_field(name="到着予定", value=jstfmt(t.arrive_utc), inline=False)
-            if t.note:
-                e.add_field(name="メモ", value=t.note, inline=False)
-            embeds.append(e)
-
-        # 一覧はチャンネルに表示
-        await inter.channel.send(embeds=embeds)
+    if len(embeds) <= chunk:
+        return await inter.followup.send(embeds=embeds, ephemeral=True)
+
+    # 1メッセージ10個までの制限があるので分割送信（一覧はチャンネルに表示、順番を保つため逐次）
+    for i in range(0, len(embeds), chunk):
+        await inter.channel.send(embeds=embeds[i:i+chunk])
 
     # コマンド実行者には控えめに完了通知
     await inter.followup.send(f"{len(tasks)}件の予約を表示しました。", ephemeral=True)
@@ -206,7 +302,7 @@ async def list_cmd(inter: discord.Interaction):
 async def cancel(inter: discord.Interaction, id: str):
     if id not in client.store.tasks:
         return await inter.response.send_message("IDが見つかりません。`/sub list` で確認してください。", ephemeral=True)
-    client.store.remove(id)
+    client.store.remove(id); client.wake.set()
     await inter.response.send_message("キャンセルしました。")
 
 @group.command(name="defer", description="予約を遅延（+30min / +1h など）")
@@ -215,29 +311,31 @@ async def defer(inter: discord.Interaction, id: str, delta: str):
     if id not in client.store.tasks:
         return await inter.response.send_message("IDが見つかりません。`/sub list` で確認してください。", ephemeral=True)
     td=parse_delta(delta)
-    t=client.store.tasks[id]; t.arrive_utc += td.total_seconds(); client.store.save()
+    t=client.store.tasks[id]; t.arrive_utc += int(td.total_seconds()); client.store.add(t); client.wake.set()
     await inter.response.send_message(f"遅延しました。新しい到着は **{jstfmt(t.arrive_utc)}** です。")
 
 @group.command(name="edit", description="登録内容の編集")
 @app_commands.describe(id="予約ID", duration="所要時間で再計算", arrive="到着日時（JST）",
-                       fc="a/p", boat="1〜4", note="メモ上書き")
+                       fc="FC", boat="1〜4", note="メモ上書き")
+@app_commands.choices(fc=FC_CHOICES, boat=BOAT_CHOICES)
 async def edit_cmd(inter: discord.Interaction, id: str, duration: Optional[str]=None, arrive: Optional[str]=None,
-                   fc: Optional[str]=None, boat: Optional[str]=None, note: Optional[str]=None):
+                   fc: Optional[app_commands.Choice[str]]=None, boat: Optional[app_commands.Choice[str]]=None,
+                   note: Optional[str]=None):
     if id not in client.store.tasks:
         return await inter.response.send_message("IDが見つかりません。`/sub list` で確認してください。", ephemeral=True)
     t=client.store.tasks[id]
     if duration:
-        td=parse_delta(duration); new_dt=datetime.now(JST)+td; t.arrive_utc=new_dt.astimezone(timezone.utc).timestamp()
+        td=parse_delta(duration); new_dt=datetime.now(JST)+td; t.arrive_utc=int(new_dt.astimezone(timezone.utc).timestamp())
     elif arrive:
         try:
-            new_dt=datetime.strptime(unicodedata.normalize("NFKC", arrive), "%Y-%m-%d %H:%M").replace(tzinfo=JST)
-            t.arrive_utc=new_dt.astimezone(timezone.utc).timestamp()
+            new_dt=parse_arrive(arrive)
+            t.arrive_utc=int(new_dt.astimezone(timezone.utc).timestamp())
         except Exception:
             return await inter.response.send_message("arrive は 'YYYY-MM-DD HH:MM'（JST）で指定してください。", ephemeral=True)
-    if fc is not None: t.fc=normalize_fc(fc)
-    if boat is not None: t.boat=normalize_boat(boat)
+    if fc is not None: t.fc=fc.value
+    if boat is not None: t.boat=boat.value
     if note is not None: t.note=note
-    client.store.save()
+    client.store.add(t); client.wake.set()
     await inter.response.send_message(f"更新しました。到着: **{jstfmt(t.arrive_utc)}** / FC:{t.fc or '-'} / 艦:{boat_label(t.boat)} / メモ:{t.note or '-'}")
 
 @client.event
@@ -247,7 +345,10 @@ async def on_ready():
         await tree.sync(); print("Commands synced")
     except Exception as e:
         print("Sync error:", e)
-    client.loop.create_task(schedule_runner())
+    # 再接続でも on_ready は呼ばれるので、wake とスケジューラは初回だけ用意する
+    if not hasattr(client, "wake"):
+        client.wake = asyncio.Event()
+        client.loop.create_task(schedule_runner())
 
 tree.add_command(group)
 client.store = TaskStore(DATA_FILE)
@@ -256,3 +357,4 @@ if __name__ == "__main__":
     token=os.getenv("DISCORD_TOKEN")
     if not token: raise SystemExit("環境変数 DISCORD_TOKEN が未設定です。Railway の Variables に設定してください。")
     client.run(token)
+    client.store.save()